@@ -14,9 +14,15 @@ Args:
 - TODO: need to handle circular references properly
 """
 
-import json, csv
+import json
+import functools
+import sys
 from jsonschema import RefResolver
-from collections import deque, namedtuple, OrderedDict, defaultdict
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from collections import OrderedDict, defaultdict
 import argparse
 
 
@@ -28,27 +34,51 @@ arg_parser.add_argument('--filter', default=('vconcat', 'hconcat', 'layer', 'spe
 
 args = arg_parser.parse_args()
 
+# filtered-out path elements as a frozenset, for C-level membership tests
+FILTER = frozenset(args.filter or ())
+
 # load Vega Lite schema and reference resolver
 with open(args.schema_path) as f:
     schema = json.load(f)
 resolver = RefResolver.from_schema(schema)
 
+@functools.lru_cache(maxsize=None)
 def resolve(ref):
+    # all refs in vega-lite are document-local (#/definitions/...): walk the
+    # cached root schema directly instead of going through RefResolver's
+    # scope push/pop machinery; keep the resolver for any non-local ref
+    if ref.startswith('#/'):
+        target = schema
+        for token in ref[2:].split('/'):
+            target = target[token.replace('~1', '/').replace('~0', '~')]
+        return target
     res = resolver.resolve(ref)
-    schema = res[1]
-    return schema
+    return res[1]
 
 # represents a node in the schema
-class Node(namedtuple('Node', ['schema', 'full_path'])):
-
-    @property
-    def path(self):
-        # remove "anyOf"s and references
-        return ('vegalite',) + tuple(key for key in self.full_path if not (key.startswith("anyOf[") or key.startswith("#/") or key=='items'))
+class Node:
+    __slots__ = ('schema', 'full_path', 'path', '_pathstr', '_hash', 'filtered')
+
+    def __init__(self, schema, full_path, path=None, filtered=None):
+        self.schema = schema
+        self.full_path = full_path
+        if path is None:
+            # remove "anyOf"s and references
+            path = ('vegalite',) + tuple(key for key in full_path if not (key.startswith("anyOf[") or key.startswith("#/") or key=='items'))
+        # path and its hash are cached at construction; they are read on every
+        # set/dict operation the node goes through
+        self.path = path
+        self._pathstr = '.'.join(path)
+        self._hash = hash(path)
+        # whether any path element hits FILTER; children() inherits the
+        # parent's bit and only checks the newly appended key
+        if filtered is None:
+            filtered = not FILTER.isdisjoint(path)
+        self.filtered = filtered
 
     @property
     def pathstr(self):
-        return '.'.join(self.path)
+        return self._pathstr
 
     @property
     def description(self):
@@ -81,69 +111,116 @@ class Node(namedtuple('Node', ['schema', 'full_path'])):
         return 'object' not in self.meta
 
     def __hash__(self):
-        return hash(self.path)
+        return self._hash
 
     def __eq__(self, other):
         return self.full_path == other.full_path
 
     def __lt__(self, other):
-        return'.'.join(self.full_path) < '.'.join(other.full_path)
+        # tuple comparison is C-level; no need to build two strings per compare
+        return self.full_path < other.full_path
 
     def __repr__(self):
         return '.'.join(self.path) + '\t' + '.'.join(self.full_path)
 
 
-def children(node):
-    """Return the children of a given node.
+# the only schema keys that can produce children
+_EXPANDABLE_KEYS = frozenset(('anyOf', '$ref', 'items', 'properties'))
 
-    Args:
-        node (Node)
+# cache of the raw children of each distinct sub-schema, keyed by id(schema).
+# _schema_by_id keeps the schemas alive so ids are never recycled.
+_children_cache = {}
+_schema_by_id = {}
 
-    Returns:
-        new_nodes (list[Node])
+def _children_raw(schema_id):
+    """Compute the (kind, key, child_schema) triples of a sub-schema, once per distinct sub-schema.
+
+    kind is 'anyOf', 'ref' or 'key'; key is the path element to append (None for 'anyOf').
     """
-    schema, full_path = node.schema, node.full_path
-    child_nodes = []
+    raw = _children_cache.get(schema_id)
+    if raw is not None:
+        return raw
+    schema = _schema_by_id[schema_id]
+    raw = []
+
+    # one set intersection instead of four independent dict lookups
+    kinds = schema.keys() & _EXPANDABLE_KEYS
 
-    if "anyOf" in schema:
-        for _, s in enumerate(schema["anyOf"]):
-            child_nodes.append(Node(s, full_path))
+    if "anyOf" in kinds:
+        for s in schema["anyOf"]:
+            raw.append(('anyOf', None, s))
 
     # jump through reference
-    if "$ref" in schema:
-        ref = schema["$ref"]
-        # avoid circular references
-        if not (ref in full_path):
-            child_nodes.append(Node(resolve(ref), full_path + [ref]))
+    if "$ref" in kinds:
+        ref = sys.intern(schema["$ref"])
+        raw.append(('ref', ref, resolve(ref)))
 
     # arrays have "items"
-    if "items" in schema:
-        child_nodes.append(Node(schema["items"], full_path + ["items"]))
+    if "items" in kinds:
+        raw.append(('key', 'items', schema["items"]))
 
     # objects have "properties"
-    if "properties" in schema:
+    if "properties" in kinds:
         for key, s in sorted(schema["properties"].items()):
-            child_nodes.append(Node(s, full_path + [key]))
+            raw.append(('key', sys.intern(key), s))
 
-    return child_nodes
+    _children_cache[schema_id] = raw
+    return raw
+
+def children(node, visited_refs):
+    """Return the children of a given node.
+
+    Args:
+        node (Node)
+        visited_refs (frozenset[str]): refs already followed on the path to this node
+
+    Returns:
+        new_states (list[(Node, frozenset[str])]): children paired with their visited_refs
+    """
+    schema, full_path, path, filtered = node.schema, node.full_path, node.path, node.filtered
+    _schema_by_id.setdefault(id(schema), schema)
+    new_states = []
+    for kind, key, s in _children_raw(id(schema)):
+        if kind == 'anyOf':
+            new_states.append((Node(s, full_path, path, filtered), visited_refs))
+        elif kind == 'ref':
+            # avoid circular references
+            if key not in visited_refs:
+                new_states.append((Node(s, full_path + (key,), path, filtered), visited_refs | {key}))
+        else:
+            # extend the parent's cached path instead of re-scanning the ancestry;
+            # 'items' is dropped from path just like refs and anyOf
+            if key == 'items':
+                child_path, child_filtered = path, filtered
+            else:
+                child_path, child_filtered = path + (key,), filtered or key in FILTER
+            new_states.append((Node(s, full_path + (key,), child_path, child_filtered), visited_refs))
+    return new_states
 
 # explore all paths, DFS
 def process_all_paths():
     node_list = []
     vocab = set()
     path_to_nodes = OrderedDict()
-    seed = Node(schema, [])
-    queue = deque([seed])
-
-    while len(queue) > 0:
-        state = queue.pop()
-        if args.filter and any(p in args.filter for p in state.path):
-            continue
+    seed = Node(schema, ())
+    stack = []
+    if not seed.filtered:
+        stack.append((seed, frozenset()))
 
+    while stack:
+        state, visited_refs = stack.pop()
         vocab.update(state.path)
         path_to_nodes[state.path] = state
-        new_states = children(state)
-        queue.extend(new_states)
+        # leaves (the majority of nodes) have nothing to expand; skip the
+        # children() call entirely (sub-schemas can also be lists, e.g. a
+        # tuple-style "items", which never expand)
+        sub_schema = state.schema
+        if not isinstance(sub_schema, dict) or not (sub_schema.keys() & _EXPANDABLE_KEYS):
+            continue
+        # prune filtered subtrees here: every descendant of a filtered node is
+        # filtered too, so there is no point queueing them at all
+        new_states = children(state, visited_refs)
+        stack.extend(s for s in new_states if not s[0].filtered)
 
     nodes = path_to_nodes.values()
     node_list = list(nodes)
@@ -161,12 +238,11 @@ def gather_edges(node_list):
         if full_node.isleaf():
             continue
         if key not in nodes:
-            node = {'key': key, 'paths': set(), 'types': set(), 'defs': set()}
+            node = {'key': key, 'paths': set(), 'types': set(), 'defs': set(), 'parents': []}
             nodes[key] = node
         else:
             node = nodes[key]
         node['paths'].add(tuple(full_node.path))
-        node['parents'] = []
         node['description'] = full_node.description
         node['types'].add(full_node.meta)
         node['defs'].add(full_node.defn)
@@ -176,12 +252,26 @@ def gather_edges(node_list):
             node[k] = list(node[k])
     return nodes
 
+def _json_default(obj):
+    if isinstance(obj, Node):
+        return obj.pathstr
+    if isinstance(obj, tuple):
+        return list(obj)
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+def dump_json(obj, path):
+    # orjson serializes in C, several times faster than stdlib json on these
+    # deeply nested dicts; the 1 MiB buffer cuts the syscall count either way
+    if orjson is not None:
+        with open(path, 'wb', buffering=1 << 20) as jsonfile:
+            jsonfile.write(orjson.dumps(obj, default=_json_default))
+    else:
+        with open(path, 'w', buffering=1 << 20) as jsonfile:
+            json.dump(obj, jsonfile, default=_json_default)
+
 node_list, vocab = process_all_paths()
 print('# nodes', len(node_list))
 print('# vocab', len(vocab), vocab)
 
-with open(args.out_path + '.graph.json', 'w') as jsonfile:
-    json.dump(list(gather_edges(node_list).values()), jsonfile)
-
-with open(args.out_path + '.paths.json', 'w') as jsonfile:
-    json.dump(list(node_list), jsonfile)
+dump_json(list(gather_edges(node_list).values()), args.out_path + '.graph.json')
+dump_json(list(node_list), args.out_path + '.paths.json')